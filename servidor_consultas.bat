@@ -0,0 +1,19 @@
+@echo off
+setlocal
+cd /d "%~dp0"
+
+if not exist "archivos\precalculos\estadisticas.json" (
+  echo ERROR: No se encontro archivos\precalculos\estadisticas.json
+  echo Ejecuta primero precalcular.bat
+  pause
+  exit /b 1
+)
+
+python tools\servidor_consultas.py %*
+
+if errorlevel 1 (
+  echo.
+  echo ERROR: El servicio de consultas se detuvo con error.
+  pause
+  exit /b 1
+)
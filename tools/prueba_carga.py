@@ -0,0 +1,197 @@
+"""
+Prueba de carga para tools/servidor_consultas.py.
+
+Lanza una mezcla de consultas de conteo, top-N y seleccion por poligono con
+varios hilos concurrentes y reporta latencias p50/p99 por tipo de consulta,
+peticiones por segundo y aciertos de cache durante la prueba.
+
+Uso:
+    python tools/prueba_carga.py [--url http://127.0.0.1:8765] [--concurrencia 16] [--peticiones 2000]
+
+Con --sin-repetir cada consulta se envia una sola vez, de modo que (con el
+servicio recien iniciado) todas las respuestas se calculan sin cache.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+# Capa de geometria -> valor de "por" para agrupar por sus entidades
+POR_CAPA = {"colonias": "colonia", "secciones": "seccion"}
+
+
+def fetch_json(url, timeout=10):
+    with urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def random_triangle(rng, bbox):
+    """Triangulo abierto (como lo enviaria el tablero) dentro de bbox."""
+    min_x, min_y, max_x, max_y = bbox
+    return [
+        [round(rng.uniform(min_x, max_x), 6), round(rng.uniform(min_y, max_y), 6)]
+        for _ in range(3)
+    ]
+
+
+def random_box(rng, bbox):
+    """Rectangulo cerrado que cubre entre 10% y 60% de cada eje de bbox."""
+    min_x, min_y, max_x, max_y = bbox
+    w = (max_x - min_x) * rng.uniform(0.1, 0.6)
+    h = (max_y - min_y) * rng.uniform(0.1, 0.6)
+    x = rng.uniform(min_x, max_x - w)
+    y = rng.uniform(min_y, max_y - h)
+    ring = [[x, y], [x + w, y], [x + w, y + h], [x, y + h], [x, y]]
+    return {"type": "Polygon", "coordinates": [[[round(a, 6), round(b, 6)] for a, b in ring]]}
+
+
+def build_requests(base_url, total, seed, share_poligono=0.25, unique=False):
+    """
+    Generar una mezcla reproducible de consultas a partir de /valores.
+    Cada elemento es (clase, url, cuerpo_json_o_None).
+    """
+    rng = random.Random(seed)
+    values = fetch_json(base_url + "/valores")
+    colonias = [item["clave"] for item in fetch_json(
+        base_url + "/top?" + urlencode({"por": "colonia", "n": 50})
+    )["items"]]
+    capas = {
+        capa: info["bbox"]
+        for capa, info in (fetch_json(base_url + "/salud").get("capas") or {}).items()
+        if info.get("bbox")
+    }
+
+    def pick(dim):
+        options = values.get(dim) or []
+        if options and rng.random() < 0.5:
+            return {dim: rng.choice(options)}
+        return {}
+
+    def make_one():
+        params = {}
+        for dim in ("mes", "tipo", "estado"):
+            params.update(pick(dim))
+        path = rng.choice(["/conteo", "/top"])
+
+        if capas and rng.random() < share_poligono:
+            capa = rng.choice(sorted(capas))
+            bbox = capas[capa]
+            params["capa"] = capa
+            params["poligono"] = random_triangle(rng, bbox) if rng.random() < 0.5 else random_box(rng, bbox)
+            if path == "/top":
+                params["por"] = rng.choice(["tipo", "estado", "mes", POR_CAPA[capa]])
+                params["n"] = 10
+            return ("poligono", base_url + path, json.dumps(params).encode("utf-8"))
+
+        if colonias and rng.random() < 0.3:
+            params["colonia"] = rng.choice(colonias)
+        if path == "/top":
+            params["por"] = rng.choice(["tipo", "estado", "mes"] + ([] if "colonia" in params else ["colonia"]))
+            params["n"] = 10
+        return (path[1:], base_url + path + "?" + urlencode(params), None)
+
+    requests = []
+    seen = set()
+    attempts = 0
+    while len(requests) < total and attempts < total * 50:
+        attempts += 1
+        item = make_one()
+        if unique:
+            if item in seen:
+                continue
+            seen.add(item)
+        requests.append(item)
+    if len(requests) < total:
+        print(f"WARN: Solo se generaron {len(requests)} consultas distintas")
+    return requests
+
+
+def timed_request(url, body, timeout):
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    started = time.perf_counter()
+    try:
+        with urlopen(Request(url, data=body, headers=headers), timeout=timeout) as response:
+            response.read()
+            ok = response.status == 200
+    except (URLError, OSError):
+        ok = False
+    return time.perf_counter() - started, ok
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del servicio de consultas")
+    parser.add_argument("--url", default="http://127.0.0.1:8765")
+    parser.add_argument("--concurrencia", type=int, default=16)
+    parser.add_argument("--peticiones", type=int, default=2000)
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--poligonos", type=float, default=0.25,
+                        help="Fraccion de consultas por poligono (POST)")
+    parser.add_argument("--sin-repetir", action="store_true",
+                        help="No repetir consultas, para medir respuestas sin cache")
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip("/")
+    try:
+        # El tamano se lee antes de build_requests (que tambien consulta al
+        # servicio) y los contadores despues, para medir solo la prueba
+        cache_size_before = fetch_json(base_url + "/salud").get("cache", {}).get("size")
+        requests = build_requests(
+            base_url, args.peticiones, args.semilla,
+            share_poligono=args.poligonos, unique=args.sin_repetir,
+        )
+        cache_before = fetch_json(base_url + "/salud").get("cache", {})
+    except (URLError, OSError) as e:
+        print("ERROR: No se pudo contactar al servicio en", base_url, "-", e)
+        return 1
+
+    print(f"Lanzando {len(requests)} peticiones con concurrencia {args.concurrencia}...")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as pool:
+        results = list(pool.map(
+            lambda item: (item[0],) + timed_request(item[1], item[2], args.timeout), requests
+        ))
+    elapsed = time.perf_counter() - started
+
+    errors = sum(1 for _, _, ok in results if not ok)
+    grupos = {"todas": [lat for _, lat, _ in results]}
+    for clase, lat, _ in results:
+        grupos.setdefault(clase, []).append(lat)
+
+    print("\n=== RESULTADOS ===")
+    print(f"Peticiones: {len(results)}  Errores: {errors}")
+    print(f"Duracion: {elapsed:.2f}s  ({len(results) / elapsed:.0f} req/s)")
+    print(f"{'consulta':<10} {'n':>6} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for clase, latencies in grupos.items():
+        latencies.sort()
+        print(f"{clase:<10} {len(latencies):>6} "
+              f"{percentile(latencies, 50) * 1000:>9.2f} "
+              f"{percentile(latencies, 99) * 1000:>9.2f} "
+              f"{latencies[-1] * 1000:>9.2f}")
+
+    try:
+        cache = fetch_json(base_url + "/salud").get("cache", {})
+        hits = cache.get("hits", 0) - cache_before.get("hits", 0)
+        misses = cache.get("misses", 0) - cache_before.get("misses", 0)
+        print(f"Cache durante la prueba: {hits} aciertos, {misses} fallos")
+        if args.sin_repetir and cache_size_before:
+            print("WARN: El servicio ya tenia respuestas en cache; reinicialo para medir en frio")
+    except (URLError, OSError):
+        pass
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
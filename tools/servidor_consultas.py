@@ -0,0 +1,551 @@
+"""
+Servicio local de consultas sobre los resultados del precalculo.
+
+Carga una sola vez archivos/precalculos/estadisticas.json y las geometrias
+enriquecidas (colonias y secciones), arma indices en memoria y responde
+conteos filtrados y rankings top-N sin recorrer las solicitudes crudas.
+
+Uso:
+    python tools/servidor_consultas.py [--puerto 8765]
+
+Endpoints (GET con parametros en la URL, o POST con un cuerpo JSON con los
+mismos nombres; los filtros aceptan varios valores):
+    /salud                          Estado del servicio y resumen de datos
+    /valores                        Valores disponibles de mes, tipo y estado
+    /conteo?colonia=&seccion=&tipo=&estado=&mes=
+    /top?por=colonia|seccion|tipo|estado|mes&n=10&<filtros>
+
+Para seleccionar por poligono enviar POST con "poligono" (geometria GeoJSON
+Polygon/MultiPolygon o lista de [lon, lat]) y opcionalmente "capa"
+("colonias" o "secciones"). Se suman las entidades cuyo centroide cae dentro.
+
+Valores de filtro desconocidos (colonia, seccion, tipo, estado o mes) y
+poligonos vacios o con vertices no finitos se responden con HTTP 400.
+"""
+import argparse
+import bisect
+import functools
+import json
+import math
+import os
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from precalcular import (
+    MONTHS,
+    OUTPUT_DIR,
+    get_bbox,
+    load_geojson,
+    normalize_key,
+    normalize_seccion,
+    parse_month,
+    point_in_polygon,
+)
+
+DEFAULT_ESTADISTICAS = os.path.join(OUTPUT_DIR, "estadisticas.json")
+DEFAULT_COLONIAS = os.path.join(OUTPUT_DIR, "colonias_enriquecidas.geojson")
+DEFAULT_SECCIONES = os.path.join(OUTPUT_DIR, "secciones_enriquecidas.geojson")
+
+# Orden de las dimensiones en las llaves compuestas del precalculo ("mes|tipo|estado")
+DIMENSIONES = ("mes", "tipo", "estado")
+CAPAS = {"colonia": "colonias", "seccion": "secciones"}
+CAPA_SINGULAR = {capa: nombre for nombre, capa in CAPAS.items()}
+TOP_N_MAX = 500
+
+
+class ConsultaInvalida(ValueError):
+    """Error de parametros que se responde al cliente con HTTP 400."""
+
+
+def _strip_ring(ring, strict=False):
+    """
+    Quitar la coordenada Z, descartar vertices invalidos y cerrar el anillo.
+    Con strict=True (poligonos enviados por el cliente) un vertice invalido
+    o no finito produce ConsultaInvalida en lugar de descartarse.
+    """
+    if not isinstance(ring, (list, tuple)):
+        if strict:
+            raise ConsultaInvalida("Cada anillo del poligono debe ser una lista")
+        return []
+    limpio = []
+    for coord in ring:
+        try:
+            x, y = float(coord[0]), float(coord[1])
+        except (TypeError, ValueError, IndexError, KeyError, OverflowError):
+            x = y = math.nan
+        if not (math.isfinite(x) and math.isfinite(y)):
+            if strict:
+                raise ConsultaInvalida(f"Vertice invalido en poligono: {coord!r}")
+            continue
+        limpio.append((x, y))
+    # point_in_polygon y _ring_centroid solo recorren vertices consecutivos
+    if limpio and limpio[0] != limpio[-1]:
+        limpio.append(limpio[0])
+    return limpio
+
+
+def _polygons_from_geometry(geom, strict=False):
+    """Regresar la lista de poligonos [exterior, hueco1, ...] de una geometria."""
+    if not isinstance(geom, dict):
+        return []
+    geom_type = geom.get("type", "")
+    coords_all = geom.get("coordinates") or []
+    if not isinstance(coords_all, (list, tuple)):
+        return []
+    if geom_type == "Polygon":
+        raw = [coords_all]
+    elif geom_type == "MultiPolygon":
+        raw = coords_all
+    else:
+        return []
+
+    polygons = []
+    for poly in raw:
+        if not isinstance(poly, (list, tuple)):
+            continue
+        rings = [_strip_ring(ring, strict) for ring in poly]
+        # Un anillo cerrado necesita al menos 3 vertices distintos
+        rings = [ring for ring in rings if len(ring) >= 4]
+        if rings:
+            polygons.append(rings)
+    return polygons
+
+
+def _ring_centroid(ring):
+    """Centroide de area de un anillo; promedio de vertices si el area es cero."""
+    area2 = 0.0
+    cx = 0.0
+    cy = 0.0
+    for i in range(len(ring) - 1):
+        x1, y1 = ring[i]
+        x2, y2 = ring[i + 1]
+        cross = x1 * y2 - x2 * y1
+        area2 += cross
+        cx += (x1 + x2) * cross
+        cy += (y1 + y2) * cross
+    if area2 == 0:
+        return (
+            sum(p[0] for p in ring) / len(ring),
+            sum(p[1] for p in ring) / len(ring),
+            0.0,
+        )
+    return (cx / (3 * area2), cy / (3 * area2), abs(area2) / 2)
+
+
+def _geometry_centroid(polygons):
+    """Centroide del anillo exterior de mayor area."""
+    best = None
+    for rings in polygons:
+        candidate = _ring_centroid(rings[0])
+        if best is None or candidate[2] > best[2]:
+            best = candidate
+    return (best[0], best[1]) if best else None
+
+
+class PreparedPolygon:
+    """Poligono de consulta con bounding boxes calculados una sola vez."""
+
+    def __init__(self, polygons):
+        self.parts = []
+        for rings in polygons:
+            self.parts.append((get_bbox(rings[0]), rings[0], rings[1:]))
+        boxes = [part[0] for part in self.parts]
+        self.bbox = (
+            min(b[0] for b in boxes),
+            min(b[1] for b in boxes),
+            max(b[2] for b in boxes),
+            max(b[3] for b in boxes),
+        )
+
+    def contains(self, point):
+        x, y = point
+        for bbox, exterior, holes in self.parts:
+            if not (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]):
+                continue
+            if point_in_polygon(point, exterior) and not any(
+                point_in_polygon(point, hole) for hole in holes
+            ):
+                return True
+        return False
+
+
+class CapaIndex:
+    """Centroides de una capa ordenados por longitud para filtrar por bbox."""
+
+    def __init__(self, features, entidades):
+        puntos = []
+        for feature in features:
+            props = feature.get("properties") or {}
+            key = props.get("STAT_KEY")
+            if key not in entidades:
+                continue
+            centroid = _geometry_centroid(_polygons_from_geometry(feature.get("geometry")))
+            if centroid:
+                puntos.append((centroid[0], centroid[1], key))
+        puntos.sort()
+        self.lons = [p[0] for p in puntos]
+        self.puntos = puntos
+        self.bbox = get_bbox([(p[0], p[1]) for p in puntos])
+
+    def keys_in(self, prepared):
+        min_x, min_y, max_x, max_y = prepared.bbox
+        start = bisect.bisect_left(self.lons, min_x)
+        end = bisect.bisect_right(self.lons, max_x)
+        found = set()
+        for lon, lat, key in self.puntos[start:end]:
+            if min_y <= lat <= max_y and prepared.contains((lon, lat)):
+                found.add(key)
+        return found
+
+
+def _value_key(value):
+    return normalize_key(str(value).replace("_", " "))
+
+
+class AgregadosIndex:
+    """Indices en memoria sobre estadisticas.json y las capas enriquecidas."""
+
+    def __init__(self, stats, capas_geo, cache_size=2048):
+        self.meta = stats.get("meta", {})
+        self.values = stats.get("values", {})
+        self.global_stats = stats.get("global", {})
+        self.entidades = {
+            "colonias": stats.get("colonias", {}),
+            "secciones": stats.get("secciones", {}),
+        }
+
+        # Llave normalizada -> valor original, para aceptar "pendiente" o "PENDIENTE"
+        # (y "sin mes" por la llave "sin_mes" del precalculo)
+        self.lookup = {}
+        for dim in DIMENSIONES:
+            self.lookup[dim] = {_value_key(v): v for v in self.values.get(dim, [])}
+        # Un mes valido sin solicitudes cuenta 0, no es un error
+        for mes in MONTHS:
+            self.lookup["mes"].setdefault(_value_key(mes), mes)
+
+        # Llave normalizada -> llave del precalculo (ya vienen normalizadas,
+        # pero tambien se indexan las etiquetas originales)
+        self.entity_lookup = {}
+        for capa, normalizer in (("colonias", normalize_key), ("secciones", normalize_seccion)):
+            index = {}
+            for key, entry in self.entidades[capa].items():
+                index[key] = key
+                label = normalizer(entry.get("label"))
+                if label:
+                    index.setdefault(label, key)
+            self.entity_lookup[capa] = index
+
+        self.capas = {}
+        for capa, geo in capas_geo.items():
+            if geo is not None:
+                self.capas[capa] = CapaIndex(geo.get("features", []), self.entidades[capa])
+
+        self._cached = functools.lru_cache(maxsize=cache_size)(self._execute)
+
+    # ----- Normalizacion de parametros -----
+
+    def _resolve_values(self, dim, raw_values):
+        if not raw_values:
+            return None
+        lookup = self.lookup[dim]
+        resolved = set()
+        for raw in raw_values:
+            value = lookup.get(_value_key(raw))
+            if value is None and dim == "mes":
+                value = lookup.get(_value_key(parse_month(raw)))
+            if value is None:
+                raise ConsultaInvalida(f"{dim} desconocido: {raw}")
+            resolved.add(value)
+        return tuple(sorted(resolved))
+
+    def _resolve_entities(self, capa, raw_values):
+        normalizer = normalize_key if capa == "colonias" else normalize_seccion
+        index = self.entity_lookup[capa]
+        resolved = set()
+        for raw in raw_values:
+            # Las llaves centinela (SIN_COLONIA, SIN_SECCION) no sobreviven a la
+            # normalizacion, por eso se busca primero el valor tal cual
+            key = index.get(raw) or index.get(normalizer(raw))
+            if not key:
+                raise ConsultaInvalida(f"{CAPA_SINGULAR[capa]} desconocida: {raw}")
+            resolved.add(key)
+        return tuple(sorted(resolved))
+
+    def build_query(self, op, params):
+        """Convertir parametros crudos en una llave hashable para el cache."""
+        def as_list(name):
+            value = params.get(name)
+            if value is None or value == "":
+                return []
+            values = value if isinstance(value, (list, tuple)) else [value]
+            values = [v for v in values if v not in (None, "")]
+            for v in values:
+                if not isinstance(v, (str, int, float)) or isinstance(v, bool):
+                    raise ConsultaInvalida(f"Valor invalido para {name}: {v!r}")
+            return values
+
+        filtros = tuple((dim, self._resolve_values(dim, as_list(dim))) for dim in DIMENSIONES)
+
+        espaciales = [name for name in ("colonia", "seccion") if as_list(name)]
+        # Un poligono vacio es un error, no "sin filtro espacial"
+        if "poligono" in params:
+            espaciales.append("poligono")
+        if len(espaciales) > 1:
+            raise ConsultaInvalida(
+                "Solo se permite un filtro espacial a la vez: " + ", ".join(espaciales)
+            )
+
+        capa = None
+        entidades = None
+        poligono = None
+        if espaciales == ["poligono"]:
+            capa_param = (as_list("capa") or ["colonias"])[0]
+            capa = CAPAS.get(capa_param, capa_param)
+            if capa not in self.capas:
+                raise ConsultaInvalida(f"Capa sin geometria cargada: {capa}")
+            poligono = self._freeze_polygon(params.get("poligono"))
+        elif espaciales:
+            capa = CAPAS[espaciales[0]]
+            entidades = self._resolve_entities(capa, as_list(espaciales[0]))
+
+        por = None
+        n = None
+        if op == "top":
+            por = (as_list("por") or ["colonia"])[0]
+            if por not in CAPAS and por not in DIMENSIONES:
+                raise ConsultaInvalida(f"Dimension desconocida para top: {por}")
+            if por in CAPAS and capa is not None and CAPAS[por] != capa:
+                raise ConsultaInvalida(f"No se puede agrupar por {por} con filtro sobre {capa}")
+            try:
+                n = int((as_list("n") or [10])[0])
+            except (TypeError, ValueError, OverflowError):
+                raise ConsultaInvalida("El parametro n debe ser entero")
+            n = max(1, min(n, TOP_N_MAX))
+
+        return (op, por, n, filtros, capa, entidades, poligono)
+
+    @staticmethod
+    def _freeze_polygon(raw):
+        if isinstance(raw, str):
+            try:
+                raw = json.loads(raw)
+            except ValueError:
+                raise ConsultaInvalida("poligono debe ser JSON")
+        if isinstance(raw, dict) and raw.get("type") == "Feature":
+            raw = raw.get("geometry")
+        if isinstance(raw, list):
+            raw = {"type": "Polygon", "coordinates": [raw]}
+        polygons = _polygons_from_geometry(raw, strict=True)
+        if not polygons:
+            raise ConsultaInvalida("poligono sin anillos validos")
+        # Redondear para que selecciones casi identicas compartan cache
+        return tuple(
+            tuple(tuple((round(x, 6), round(y, 6)) for x, y in ring) for ring in rings)
+            for rings in polygons
+        )
+
+    # ----- Ejecucion -----
+
+    def query(self, op, params):
+        """Responder una consulta; regresa el cuerpo JSON ya serializado."""
+        return self._cached(self.build_query(op, params))
+
+    def cache_info(self):
+        return self._cached.cache_info()
+
+    @staticmethod
+    def _count_entity(entry, filtros):
+        """Sumar la tabla marginal del precalculo que corresponde a los filtros."""
+        active = [(dim, values) for dim, values in filtros if values is not None]
+        if not active:
+            return entry.get("total", 0)
+        table = entry.get("_".join(dim for dim, _ in active), {})
+        combos = [()]
+        for _, values in active:
+            combos = [combo + (value,) for combo in combos for value in values]
+        return sum(table.get("|".join(combo), 0) for combo in combos)
+
+    def _scope(self, capa, entidades, poligono):
+        if poligono is not None:
+            keys = self.capas[capa].keys_in(PreparedPolygon(poligono))
+            return capa, sorted(keys)
+        if entidades is not None:
+            return capa, list(entidades)
+        return None, None
+
+    def _execute(self, query):
+        op, por, n, filtros, capa, entidades, poligono = query
+        capa, keys = self._scope(capa, entidades, poligono)
+
+        if op == "conteo":
+            if keys is None:
+                total = self._count_entity(self.global_stats, filtros)
+            else:
+                total = sum(
+                    self._count_entity(self.entidades[capa][key], filtros) for key in keys
+                )
+            result = {"total": total}
+            if keys is not None:
+                result["capa"] = capa
+                result["entidades"] = len(keys)
+            return json.dumps(result, ensure_ascii=False).encode("utf-8")
+
+        if por in CAPAS:
+            capa_top = CAPAS[por]
+            source = self.entidades[capa_top]
+            candidates = keys if keys is not None else list(source.keys())
+            items = []
+            for key in candidates:
+                entry = source[key]
+                total = self._count_entity(entry, filtros)
+                if total:
+                    items.append({"clave": key, "label": entry.get("label"), "total": total})
+        else:
+            entries = (
+                [self.global_stats] if keys is None
+                else [self.entidades[capa][key] for key in keys]
+            )
+            filtros_dict = dict(filtros)
+            candidates = filtros_dict[por] or self.values.get(por, [])
+            items = []
+            for value in candidates:
+                filtros_valor = tuple(
+                    (dim, (value,) if dim == por else values) for dim, values in filtros
+                )
+                total = sum(self._count_entity(entry, filtros_valor) for entry in entries)
+                if total:
+                    items.append({"clave": value, "label": value, "total": total})
+
+        items.sort(key=lambda item: (-item["total"], str(item["clave"])))
+        result = {"por": por, "items": items[:n]}
+        return json.dumps(result, ensure_ascii=False).encode("utf-8")
+
+
+class ConsultasHandler(BaseHTTPRequestHandler):
+    index = None
+    started = None
+
+    def log_message(self, format, *args):
+        # Silenciar el log por peticion; con carga concurrente satura la consola
+        pass
+
+    def _send(self, status, body):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.end_headers()
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = {k: v if len(v) > 1 else v[0] for k, v in parse_qs(parsed.query).items()}
+        self._dispatch(parsed.path, params)
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self._send(400, {"error": "Content-Length invalido"})
+            return
+        try:
+            params = json.loads(self.rfile.read(max(length, 0)) or b"{}")
+        except ValueError:
+            self._send(400, {"error": "Cuerpo JSON invalido"})
+            return
+        if not isinstance(params, dict):
+            self._send(400, {"error": "El cuerpo debe ser un objeto JSON"})
+            return
+        self._dispatch(parsed.path, params)
+
+    def _dispatch(self, path, params):
+        path = path.rstrip("/") or "/"
+        try:
+            if path == "/salud":
+                info = self.index.cache_info()
+                self._send(200, {
+                    "ok": True,
+                    "records": self.index.meta.get("records"),
+                    "generatedAt": self.index.meta.get("generatedAt"),
+                    "uptime": round(time.time() - self.started, 1),
+                    "cache": {"hits": info.hits, "misses": info.misses, "size": info.currsize},
+                    "capas": {capa: {"bbox": index.bbox} for capa, index in self.index.capas.items()},
+                })
+            elif path == "/valores":
+                self._send(200, self.index.values)
+            elif path in ("/conteo", "/top"):
+                self._send(200, self.index.query(path[1:], params))
+            else:
+                self._send(404, {"error": f"Ruta desconocida: {path}"})
+        except ConsultaInvalida as e:
+            self._send(400, {"error": str(e)})
+        except Exception as e:
+            # Responder siempre con JSON; si no, el cliente solo ve la conexion cerrada
+            print(f"ERROR en {path}: {e!r}")
+            self._send(500, {"error": "Error interno del servicio"})
+
+
+class ConsultasServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # El valor por omision (5) descarta conexiones cuando hay muchos clientes a la vez
+    request_queue_size = 128
+
+
+def load_index(stats_path, colonias_path, secciones_path, cache_size):
+    print("Leyendo", stats_path)
+    stats = load_geojson(stats_path)
+    capas_geo = {}
+    for capa, path in (("colonias", colonias_path), ("secciones", secciones_path)):
+        if os.path.exists(path):
+            print("Leyendo", path)
+            capas_geo[capa] = load_geojson(path)
+        else:
+            print("WARN: No existe", path, "- sin consultas por poligono sobre", capa)
+    return AgregadosIndex(stats, capas_geo, cache_size=cache_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servicio local de consultas sobre el precalculo")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--estadisticas", default=DEFAULT_ESTADISTICAS)
+    parser.add_argument("--colonias", default=DEFAULT_COLONIAS)
+    parser.add_argument("--secciones", default=DEFAULT_SECCIONES)
+    parser.add_argument("--cache", type=int, default=2048, help="Respuestas a conservar en cache")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.estadisticas):
+        print("ERROR: No existe", args.estadisticas)
+        print("Ejecuta primero precalcular.bat")
+        return 1
+
+    started = time.time()
+    ConsultasHandler.index = load_index(args.estadisticas, args.colonias, args.secciones, args.cache)
+    ConsultasHandler.started = time.time()
+    print(f"OK: Indices listos en {time.time() - started:.2f}s")
+
+    server = ConsultasServer((args.host, args.puerto), ConsultasHandler)
+    print(f"Escuchando en http://{args.host}:{args.puerto} (Ctrl+C para detener)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
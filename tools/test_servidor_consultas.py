@@ -0,0 +1,249 @@
+"""
+Pruebas de tools/servidor_consultas.py con un precalculo pequeno en memoria.
+
+Uso:
+    python -m unittest discover -s tools
+"""
+import http.client
+import json
+import math
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from precalcular import ensure_entity, increment  # noqa: E402
+from servidor_consultas import (  # noqa: E402
+    AgregadosIndex,
+    ConsultaInvalida,
+    ConsultasHandler,
+    ConsultasServer,
+)
+
+# (colonia, etiqueta, seccion, mes, tipo, estado)
+REGISTROS = [
+    ("EL BATAN", "EL BATAN", "3260", "enero", "Bacheo", "Pendiente"),
+    ("EL BATAN", "EL BATAN", "3260", "enero", "Poda", "Atendido"),
+    ("EL BATAN", "EL BATAN", "3261", "febrero", "Bacheo", "En atención"),
+    ("LAS AGUILAS", "LAS ÁGUILAS", "3261", "enero", "Alumbrado", "Pendiente"),
+    ("LAS AGUILAS", "LAS ÁGUILAS", "3261", "febrero", "Bacheo", "Pendiente"),
+    ("LAS AGUILAS", "LAS ÁGUILAS", "3262", "febrero", "Poda", "Pendiente"),
+    ("SIN_COLONIA", None, "SIN_SECCION", "sin_mes", "Bacheo", "Sin estado"),
+]
+
+
+def _square(cx, cy, half=0.01):
+    ring = [
+        [cx - half, cy - half, 0.0], [cx + half, cy - half, 0.0],
+        [cx + half, cy + half, 0.0], [cx - half, cy + half, 0.0],
+        [cx - half, cy - half, 0.0],
+    ]
+    return {"type": "MultiPolygon", "coordinates": [[ring]]}
+
+
+def _build_stats():
+    stats_global = ensure_entity({}, "global", None)
+    colonias = {}
+    secciones = {}
+    for colonia, label, seccion, mes, tipo, estado in REGISTROS:
+        seccion_label = None if seccion == "SIN_SECCION" else int(seccion)
+        for entry in (
+            stats_global,
+            ensure_entity(colonias, colonia, label),
+            ensure_entity(secciones, seccion, seccion_label),
+        ):
+            entry["total"] += 1
+            increment(entry["mes"], mes)
+            increment(entry["tipo"], tipo)
+            increment(entry["estado"], estado)
+            increment(entry["mes_tipo"], f"{mes}|{tipo}")
+            increment(entry["mes_estado"], f"{mes}|{estado}")
+            increment(entry["tipo_estado"], f"{tipo}|{estado}")
+            increment(entry["mes_tipo_estado"], f"{mes}|{tipo}|{estado}")
+    return {
+        "meta": {"records": len(REGISTROS)},
+        "values": {
+            "mes": sorted({r[3] for r in REGISTROS}),
+            "tipo": sorted({r[4] for r in REGISTROS}),
+            "estado": sorted({r[5] for r in REGISTROS}),
+        },
+        "global": stats_global,
+        "colonias": colonias,
+        "secciones": secciones,
+    }
+
+
+def _build_index():
+    colonias_geo = {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": {"STAT_KEY": "EL BATAN"}, "geometry": _square(-99.20, 19.40)},
+        {"type": "Feature", "properties": {"STAT_KEY": "LAS AGUILAS"}, "geometry": _square(-99.10, 19.40)},
+    ]}
+    return AgregadosIndex(_build_stats(), {"colonias": colonias_geo})
+
+
+def _query(index, op, params):
+    return json.loads(index.query(op, params))
+
+
+class AgregadosIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = _build_index()
+
+    def test_conteo_sin_filtros(self):
+        self.assertEqual(_query(self.index, "conteo", {})["total"], len(REGISTROS))
+
+    def test_top_colonias_suma_igual_a_conteo_global(self):
+        for filtros in ({}, {"tipo": "Bacheo"}, {"mes": "febrero", "estado": "Pendiente"},
+                        {"mes": "enero", "tipo": "Bacheo", "estado": "Pendiente"}):
+            top = _query(self.index, "top", dict(filtros, por="colonia", n=100))
+            total = _query(self.index, "conteo", filtros)["total"]
+            self.assertEqual(sum(item["total"] for item in top["items"]), total, filtros)
+
+    def test_top_por_dimension_suma_igual_a_conteo(self):
+        filtros = {"colonia": "EL BATAN"}
+        top = _query(self.index, "top", dict(filtros, por="tipo"))
+        self.assertEqual(sum(item["total"] for item in top["items"]),
+                         _query(self.index, "conteo", filtros)["total"])
+
+    def test_filtros_multivalor_se_suman(self):
+        ambos = _query(self.index, "conteo", {"tipo": ["Bacheo", "Poda"], "mes": ["enero", "febrero"]})
+        partes = sum(
+            _query(self.index, "conteo", {"tipo": tipo, "mes": mes})["total"]
+            for tipo in ("Bacheo", "Poda") for mes in ("enero", "febrero")
+        )
+        self.assertEqual(ambos["total"], partes)
+        self.assertEqual(ambos["total"], 5)
+
+    def test_normalizacion_de_mes_tipo_y_colonia(self):
+        self.assertEqual(
+            _query(self.index, "conteo", {"mes": "1", "tipo": "BACHEO", "colonia": "el batan"})["total"],
+            1,
+        )
+        self.assertEqual(_query(self.index, "conteo", {"colonia": "Las Águilas"})["total"], 3)
+
+    def test_llaves_sin_colonia_y_sin_seccion(self):
+        claves = [item["clave"] for item in _query(self.index, "top", {"por": "colonia"})["items"]]
+        self.assertIn("SIN_COLONIA", claves)
+        self.assertEqual(_query(self.index, "conteo", {"colonia": "SIN_COLONIA"})["total"], 1)
+        self.assertEqual(_query(self.index, "conteo", {"seccion": "SIN_SECCION"})["total"], 1)
+
+    def test_colonia_desconocida(self):
+        with self.assertRaises(ConsultaInvalida):
+            self.index.query("conteo", {"colonia": "NO EXISTE"})
+        with self.assertRaisesRegex(ConsultaInvalida, "^seccion desconocida"):
+            self.index.query("conteo", {"seccion": "99999"})
+
+    def test_valores_desconocidos(self):
+        for filtros in ({"tipo": "Graffiti"}, {"estado": "Cerrado"}, {"mes": "xyz"}, {"mes": "13"}):
+            with self.assertRaises(ConsultaInvalida, msg=filtros):
+                self.index.query("conteo", filtros)
+
+    def test_mes_sin_registros_y_sin_mes(self):
+        self.assertEqual(_query(self.index, "conteo", {"mes": "diciembre"})["total"], 0)
+        self.assertEqual(_query(self.index, "conteo", {"mes": "sin mes"})["total"], 1)
+        self.assertEqual(_query(self.index, "conteo", {"mes": "sin_mes"})["total"], 1)
+
+    def test_poligono_vacio_o_no_finito(self):
+        for poligono in ([], [[math.nan, 19.3], [-99.1, 19.3], [-99.1, 19.4]],
+                         [[-99.2, 19.3], [math.inf, 19.3], [-99.1, 19.4]],
+                         [[-99.2, 19.3], ["1e400", 19.3], [-99.1, 19.4]]):
+            with self.assertRaises(ConsultaInvalida, msg=poligono):
+                self.index.query("conteo", {"poligono": poligono})
+
+    def test_n_no_finito(self):
+        for n in (math.inf, 1e400, math.nan):
+            with self.assertRaises(ConsultaInvalida, msg=n):
+                self.index.query("top", {"por": "tipo", "n": n})
+
+    def test_poligono_abierto_y_cerrado(self):
+        abierto = [[-99.30, 19.35], [-99.15, 19.35], [-99.15, 19.50]]
+        cerrado = abierto + [abierto[0]]
+        resultados = [
+            _query(self.index, "conteo", {"poligono": ring}) for ring in (abierto, cerrado)
+        ]
+        self.assertEqual(resultados[0], resultados[1])
+        # Solo el centroide de EL BATAN (-99.20, 19.40) queda dentro del triangulo
+        self.assertEqual(resultados[0]["entidades"], 1)
+        self.assertEqual(resultados[0]["total"], 3)
+
+    def test_poligono_geojson(self):
+        geom = {"type": "Polygon", "coordinates": [[
+            [-99.3, 19.3], [-99.0, 19.3], [-99.0, 19.5], [-99.3, 19.5], [-99.3, 19.3],
+        ]]}
+        top = _query(self.index, "top", {"poligono": geom, "por": "colonia"})
+        self.assertEqual({item["clave"] for item in top["items"]}, {"EL BATAN", "LAS AGUILAS"})
+
+
+class ConsultasHandlerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        ConsultasHandler.index = _build_index()
+        ConsultasHandler.started = 0
+        cls.server = ConsultasServer(("127.0.0.1", 0), ConsultasHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def _post(self, path, body, headers=None):
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=5)
+        try:
+            conn.request("POST", path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def test_cuerpos_invalidos_responden_400(self):
+        cuerpos = [
+            "no es json",
+            "[1, 2]",
+            '{"poligono": {"type": "Polygon", "coordinates": 5}}',
+            '{"poligono": [{"a": 1}, {"b": 2}, {"c": 3}]}',
+            '{"por": {"a": 1}}',
+            '{"poligono": [[-99.2, 19.3], [-99.1, 19.3], [-99.1, 19.4]], "capa": [[1]]}',
+            '{"colonia": "EL BATAN", "seccion": "3260"}',
+            '{"poligono": []}',
+            '{"poligono": [[NaN, 19.3], [-99.1, 19.3], [-99.1, 19.4]]}',
+            '{"por": "tipo", "n": 1e400}',
+            '{"por": "tipo", "n": Infinity}',
+            '{"mes": "sin mess"}',
+        ]
+        for cuerpo in cuerpos:
+            status, data = self._post("/top", cuerpo.encode("utf-8"))
+            self.assertEqual(status, 400, cuerpo)
+            self.assertIn("error", data)
+
+    def test_content_length_invalido(self):
+        status, data = self._post("/conteo", b"{}", headers={"Content-Length": "abc"})
+        self.assertEqual(status, 400)
+        self.assertIn("error", data)
+
+    def test_error_interno_responde_500(self):
+        index = ConsultasHandler.index
+        original = index._cached
+
+        def falla(query):
+            raise KeyError("mes_tipo_estado")
+
+        index._cached = falla
+        try:
+            status, data = self._post("/conteo", b"{}")
+        finally:
+            index._cached = original
+        self.assertEqual(status, 500)
+        self.assertIn("error", data)
+
+    def test_post_valido(self):
+        status, data = self._post("/conteo", json.dumps({"tipo": ["Bacheo"]}).encode("utf-8"))
+        self.assertEqual(status, 200)
+        self.assertEqual(data["total"], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()